@@ -1,9 +1,24 @@
 import asyncio
-import datetime
 import csv
+import functools
+import logging
 import os
+import queue
+import re
+import struct
+import sys
+import threading
+import time
 from bleak import BleakClient
 
+try:
+    import uvloop as fast_loop  # optional, schnellere Event-Loop auf Linux/macOS
+except ImportError:
+    try:
+        import winloop as fast_loop  # gleiche API unter Windows
+    except ImportError:
+        fast_loop = None
+
 # Geräteadressen (Name: MAC)
 devices = {
     "akku-1": "A4:C1:38:A0:D1:5B",
@@ -15,103 +30,255 @@ CHAR_NOTIFY = "0000ff01-0000-1000-8000-00805f9b34fb"
 CHAR_WRITE  = "0000ff02-0000-1000-8000-00805f9b34fb"
 CMD_CELLS   = bytes.fromhex("DD A5 04 00 FF FC 77")
 CMD_STATUS  = bytes.fromhex("DD A5 03 00 FF FD 77")
+CELLS_PREFIX  = b"\xDD\x04"  # Antwort-Kopf Zellspannungen
+STATUS_PREFIX = b"\xDD\x03"  # Antwort-Kopf Status
+FRAME_TIMEOUT = 1.5  # Sekunden, maximal auf eine Antwort warten
+POLL_INTERVAL = 5   # Sekunden pro Abfragezyklus
 
+# Rohdaten-Ausgabe pro Paket nur mit BATCHECK_DEBUG=1 (Log-Level DEBUG)
+DEBUG = os.environ.get("BATCHECK_DEBUG", "") not in ("", "0")  # jeder andere Wert schaltet ein
+log = logging.getLogger("batcheck")
 log_dir = "logs"
 os.makedirs(log_dir, exist_ok=True)
 
 # Buffer und CSV pro Gerät
 notify_buffer = {name: bytearray() for name in devices}
+notify_events = {}
+frame_events = {}  # je Pakettyp ein Event, gesetzt sobald so ein Paket geparst wurde
+NOTIFY_BATCH_DELAY = 0.05  # Sekunden, Fragmente sammeln bevor geparst wird
+NOTIFY_BUFFER_MAX = 4096   # darüber ist der Buffer nur noch Datenmüll
+NOTIFY_BUFFER_KEEP = 1024  # so viele Bytes bleiben beim Kürzen stehen
+FRAME_DATA_MAX = 64  # Byte Nutzdaten, reicht für 32 Zellen und jedes Statuspaket
+# Paketanfang: DD, Typ 03/04. Das Ende steht im Längenbyte, nicht an der
+# ersten 77 (die kann auch in den Daten oder der Prüfsumme vorkommen)
+FRAME_START_RE = re.compile(rb"\xDD[\x03\x04]")
+VOLT_FMT = "{:.3f} V".format  # einmal gebunden, spart Lookup pro Zelle
+last_stamp = [0, "--:--:--"]  # zuletzt formatierte Sekunde und Text
 csv_paths = {name: os.path.join(log_dir, f"{name}.csv") for name in devices}
+csv_files = {}
+csv_writers = {}
+csv_rows = {name: 0 for name in devices}
+CSV_FLUSH_ROWS = 10  # nach so vielen Zeilen auf die Karte schreiben
+CSV_BATCH_ROWS = 32  # höchstens so viele Zeilen pro writerows
+csv_queue = queue.SimpleQueue()  # (name, zeile) oder None zum Beenden, abgearbeitet von csv_writer_loop
+
+def open_csv_logs():
+    # CSV-Dateien einmal öffnen statt pro Paket open/close
+    for name in devices:
+        csv_files[name] = open(csv_paths[name], "a", newline="", buffering=64*1024)
+        csv_writers[name] = csv.writer(csv_files[name])
+
+def close_csv_logs():
+    for f in csv_files.values():
+        f.close()
+    csv_files.clear()
+    csv_writers.clear()
+
+def write_csv_batch(batch):
+    # Pro Gerät ein writerows statt einer writerow pro Paket
+    rows = {}
+    for name, row in batch:
+        rows.setdefault(name, []).append(row)
+    batch.clear()
+    for name, dev_rows in rows.items():
+        csv_writers[name].writerows(dev_rows)
+        csv_rows[name] += len(dev_rows)
+        if csv_rows[name] >= CSV_FLUSH_ROWS:
+            csv_files[name].flush()
+            csv_rows[name] = 0
+
+def csv_writer_loop():
+    # Eigener Thread besitzt die Dateien, langsame SD-Karten bremsen den Loop nicht
+    open_csv_logs()
+    batch = []
+    while True:
+        item = csv_queue.get()
+        if item is None:
+            break
+        batch.append(item)
+        if len(batch) >= CSV_BATCH_ROWS or csv_queue.empty():
+            write_csv_batch(batch)
+    write_csv_batch(batch)
+    close_csv_logs()
 
 def debug_bytes(data):
     return " ".join(f"{b:02X}" for b in data)
 
+# Vorkompilierte Formate: Zellen je Anzahl (bis 32) und Status-Kopf
+CELL_STRUCTS = {n: struct.Struct(f">{n}H") for n in range(33)}
+STATUS_STRUCT = struct.Struct(">HhHHH")  # Spannung, Strom, Rest, Nenn, Zyklen
+
+def timestamp():
+    # HH:MM:SS nur neu formatieren, wenn eine neue Sekunde angefangen hat
+    sec = int(time.time())
+    if sec != last_stamp[0]:
+        last_stamp[0] = sec
+        last_stamp[1] = time.strftime("%H:%M:%S", time.localtime(sec))
+    return last_stamp[1]
+
+def header_ok(buf, start):
+    # Plausibler Antwortkopf: Typ 03/04, Status 00/80, Länge im Rahmen.
+    # Sonst würde ein zufälliges DD mit großer Länge das Parsen aufhalten
+    return (buf[start+1] in PACKET_HANDLERS and buf[start+2] in (0x00, 0x80)
+            and buf[start+3] <= FRAME_DATA_MAX)
+
+def frame_ok(packet):
+    # Endbyte 77 und JBD-Prüfsumme: 0x10000 - Summe(Status, Länge, Daten), steht vor der 77
+    if len(packet) < 7 or packet[-1] != 0x77:
+        return False
+    s = sum(memoryview(packet)[2:-3])
+    return (0x10000 - s) & 0xFFFF == int.from_bytes(packet[-3:-1], "big")
+
 def parse_cell_voltages(packet):
     # Prüfe auf korrektes Paket: DD 04 ... 77
-    if not packet.startswith(b'\xDD') or packet[1] != 0x04 or packet[-1] != 0x77:
+    if not (packet.startswith(CELLS_PREFIX) and packet.endswith(b"\x77")):
         print("❌ Kein Zellspannungs-Paket!")
         return []
-    data = packet[4:-3]  # Header (4 Byte) und Footer (3 Byte) entfernen
-    voltages = []
-    for i in range(0, len(data), 2):
-        if i + 1 >= len(data):
-            break
-        v = int.from_bytes(data[i:i+2], 'big') / 1000.0
-        voltages.append(v)
-    return voltages
+    data = memoryview(packet)[4:-3]  # Header (4 Byte) und Footer (3 Byte) entfernen
+    n = len(data) // 2
+    cell_struct = CELL_STRUCTS.get(n) or struct.Struct(f">{n}H")
+    raw = cell_struct.unpack_from(data)
+    return [v / 1000.0 for v in raw]
 
 def parse_status(packet):
     # Prüfe auf korrektes Paket: DD 03 ... 77
-    if not packet.startswith(b'\xDD') or packet[1] != 0x03 or packet[-1] != 0x77:
+    if not (packet.startswith(STATUS_PREFIX) and packet.endswith(b"\x77")):
         return None
-    data = packet[4:-3]
+    data = memoryview(packet)[4:-3]
     if len(data) < 22:
         print("⚠️ Statusdaten zu kurz")
         return None
-    total_voltage = int.from_bytes(data[0:2], 'big') / 100.0
-    current = int.from_bytes(data[2:4], 'big', signed=True) / 100.0
-    residual_capacity = int.from_bytes(data[4:6], 'big') / 100.0
-    nominal_capacity = int.from_bytes(data[6:8], 'big') / 100.0
-    cycles = int.from_bytes(data[8:10], 'big')
+    fields = STATUS_STRUCT.unpack_from(data)
+    total_voltage, current, residual_capacity, nominal_capacity, cycles = fields
     soc = data[21]
     return {
-        "Spannung": total_voltage,
-        "Strom": current,
-        "RestAh": residual_capacity,
-        "NennAh": nominal_capacity,
+        "Spannung": total_voltage / 100.0,
+        "Strom": current / 100.0,
+        "RestAh": residual_capacity / 100.0,
+        "NennAh": nominal_capacity / 100.0,
         "Zyklen": cycles,
         "SoC": soc,
     }
 
+async def send_and_wait(name, client, cmd):
+    # Befehl schicken und auf das Antwortpaket warten (höchstens FRAME_TIMEOUT)
+    # Nur eine Antwort vom erwarteten Typ zählt (cmd[2]: 03 oder 04)
+    event = frame_events[name][cmd[2]]
+    event.clear()
+    await client.write_gatt_char(CHAR_WRITE, cmd)
+    try:
+        await asyncio.wait_for(event.wait(), timeout=FRAME_TIMEOUT)
+    except asyncio.TimeoutError:
+        pass
+
+async def query_bms(name, client):
+    # Nächster Befehl erst nach der Antwort, keine festen Pausen dazwischen
+    await send_and_wait(name, client, CMD_CELLS)
+    await send_and_wait(name, client, CMD_STATUS)
+
+async def wait_next_poll(started):
+    # Zyklus ab Start der Abfrage rechnen, Antwortzeit geht nicht obendrauf
+    await asyncio.sleep(max(0.0, POLL_INTERVAL - (time.monotonic() - started)))
+
 async def monitor_bms(name, address):
+    on_notify = functools.partial(handle_notify, name)
     print(f"[{name}] 🔌 Verbinde mit {address}...")
     try:
         async with BleakClient(address) as client:
             print(f"[{name}] ✅ Verbunden")
-            notify_buffer[name] = bytearray()
-            await client.start_notify(CHAR_NOTIFY, lambda _, d: handle_notify(name, d))
-            await asyncio.sleep(1)
-            await client.write_gatt_char(CHAR_WRITE, CMD_CELLS)
-            await asyncio.sleep(0.2)
-            await client.write_gatt_char(CHAR_WRITE, CMD_STATUS)
-            while True:
-                await asyncio.sleep(5)
-                await client.write_gatt_char(CHAR_WRITE, CMD_CELLS)
-                await asyncio.sleep(0.2)
-                await client.write_gatt_char(CHAR_WRITE, CMD_STATUS)
+            notify_buffer[name].clear()
+            notify_events[name] = asyncio.Event()
+            frame_events[name] = {typ: asyncio.Event() for typ in PACKET_HANDLERS}
+            drain_task = asyncio.create_task(drain_notify(name))
+            try:
+                await client.start_notify(CHAR_NOTIFY, on_notify)
+                await asyncio.sleep(1)
+                while True:
+                    started = time.monotonic()
+                    await query_bms(name, client)
+                    await wait_next_poll(started)
+            finally:
+                drain_task.cancel()
     except Exception as e:
         print(f"[{name}] BLE-Fehler: {e}")
 
-def handle_notify(name, data):
-    notify_buffer[name] += data
-    # Wir suchen nach Paketen, die mit DD starten und mit 77 enden
+def handle_notify(name, _sender, data):
+    # Nur puffern, geparst wird gesammelt in drain_notify
+    notify_buffer[name].extend(data)  # derselbe Buffer, kein Zurückschreiben ins dict
+    notify_events[name].set()
+
+async def drain_notify(name):
+    event = notify_events[name]
     while True:
-        buf = notify_buffer[name]
-        if len(buf) < 2:
-            break
-        try:
-            start = buf.index(0xDD)
-            end = buf.index(0x77, start)
-            packet = buf[start:end+1]
-            notify_buffer[name] = buf[end+1:]
-        except ValueError:
-            break
+        await event.wait()
+        # Kurz warten, damit die restlichen Fragmente des Pakets mitkommen
+        await asyncio.sleep(NOTIFY_BATCH_DELAY)
+        event.clear()
+        drain_and_parse(name)
+
+def handle_cells_packet(name, packet, now):
+    voltages = parse_cell_voltages(packet)
+    if voltages:
+        total_v = sum(voltages)
+        print(f"[{name}] 🔋 Zellspannungen: " + " | ".join(map(VOLT_FMT, voltages)))
+        print(f"[{name}] ➡️ Gesamtspannung (Summe Zellen): {total_v:.3f} V")
+        csv_queue.put((name, [now] + voltages))
 
-        print(f"[{name}] [RAW] {packet.hex()}")
-        if packet[1] == 0x04:
-            voltages = parse_cell_voltages(packet)
-            if voltages:
-                now = datetime.datetime.now().strftime("%H:%M:%S")
-                total_v = sum(voltages)
-                print(f"[{name}] 🔋 Zellspannungen: " + " | ".join(f"{v:.3f} V" for v in voltages))
-                print(f"[{name}] ➡️ Gesamtspannung (Summe Zellen): {total_v:.3f} V")
-                with open(csv_paths[name], "a", newline="") as f:
-                    writer = csv.writer(f)
-                    writer.writerow([now] + voltages)
-        elif packet[1] == 0x03:
-            status = parse_status(packet)
-            if status:
-                print(f"[{name}] ⚡️ Spannung: {status['Spannung']:.2f} V | Strom: {status['Strom']:.2f} A | Rest: {status['RestAh']:.2f} Ah | Nenn: {status['NennAh']:.2f} Ah | Zyklen: {status['Zyklen']} | SoC: {status['SoC']}%")
+def handle_status_packet(name, packet, now):
+    status = parse_status(packet)
+    if status:
+        print(f"[{name}] ⚡️ Spannung: {status['Spannung']:.2f} V | Strom: {status['Strom']:.2f} A | Rest: {status['RestAh']:.2f} Ah | Nenn: {status['NennAh']:.2f} Ah | Zyklen: {status['Zyklen']} | SoC: {status['SoC']}%")
+
+# Pakettyp (Byte 1) -> Auswertung
+PACKET_HANDLERS = {
+    0x04: handle_cells_packet,
+    0x03: handle_status_packet,
+}
+
+def drain_and_parse(name):
+    buf = notify_buffer[name]
+    # Ein Zeitstempel für alle Pakete dieses Durchlaufs
+    now = timestamp()
+    # Lesezeiger statt Löschen pro Paket, der Buffer wird einmal am Ende gekürzt
+    pos = 0
+    while True:
+        m = FRAME_START_RE.search(buf, pos)
+        if m is None:
+            # Kein Paketanfang mehr, nur ein DD ganz am Ende aufheben
+            pos = len(buf) - 1 if buf.endswith(b"\xDD") else len(buf)
+            break
+        start = m.start()
+        pos = start
+        # Kopf (4), Daten[LEN], CRC (2), Endbyte (1)
+        if len(buf) - start < 7:
+            break  # Länge noch nicht da
+        if not header_ok(buf, start):
+            pos = start + 1  # kein echter Paketanfang, weitersuchen
+            continue
+        total_len = 4 + buf[start+3] + 3
+        if len(buf) - start < total_len:
+            break  # Warte auf den Rest
+        with memoryview(buf) as mv:
+            packet = bytes(mv[start:start+total_len])
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("[%s] [RAW] %s", name, packet.hex())
+        if not frame_ok(packet):
+            print(f"[{name}] ⚠️ Prüfsumme oder Endbyte falsch, Paket verworfen")
+            # Längenbyte war falsch, ab dem nächsten Byte neu suchen
+            pos = start + 1
+            continue
+        pos = start + total_len
+        event = frame_events[name].get(packet[1])
+        if event:
+            event.set()
+        handler = PACKET_HANDLERS.get(packet[1])
+        if handler:
+            handler(name, packet, now)
+    # Verbrauchte Bytes im selben Buffer entfernen statt Rest zu kopieren
+    del buf[:pos]
+    # Unvollständiger Rest wächst ohne Endbyte nicht unbegrenzt
+    if len(buf) > NOTIFY_BUFFER_MAX:
+        del buf[:len(buf)-NOTIFY_BUFFER_KEEP]
 
 async def main():
     tasks = []
@@ -119,8 +286,29 @@ async def main():
         tasks.append(asyncio.create_task(monitor_bms(name, address)))
     await asyncio.gather(*tasks)
 
+def run_main():
+    # Loop direkt aus der Fabrik statt über die ab 3.14 veraltete Loop-Policy
+    if fast_loop is None:
+        asyncio.run(main())
+    elif sys.version_info >= (3, 12):
+        asyncio.run(main(), loop_factory=fast_loop.new_event_loop)
+    else:
+        # Vor 3.12 kennt asyncio.run keine loop_factory, dort ist die Policy
+        # noch nicht veraltet. asyncio.run bricht beim Beenden die Tasks ab,
+        # damit die BLE-Verbindungen sauber getrennt werden
+        asyncio.set_event_loop_policy(fast_loop.EventLoopPolicy())
+        asyncio.run(main())
+
 if __name__ == "__main__":
+    logging.basicConfig(format="%(message)s", level=logging.INFO)
+    # Nur die eigenen Rohdaten auf DEBUG, bleak und dbus bleiben auf INFO
+    log.setLevel(logging.DEBUG if DEBUG else logging.INFO)
+    csv_thread = threading.Thread(target=csv_writer_loop, daemon=True)
+    csv_thread.start()
     try:
-        asyncio.run(main())
+        run_main()
     except KeyboardInterrupt:
         print("⛔️ Beende Programm...")
+    finally:
+        csv_queue.put(None)  # Rest schreiben und Dateien schließen
+        csv_thread.join()
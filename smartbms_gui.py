@@ -2,11 +2,23 @@ import tkinter as tk
 from tkinter import ttk
 import asyncio
 import threading
-import datetime
 import csv
+import functools
+import logging
 import os
+import queue
+import struct
+import time
 from bleak import BleakClient
 
+try:
+    import uvloop as fast_loop  # optional, schnellere Event-Loop auf Linux/macOS
+except ImportError:
+    try:
+        import winloop as fast_loop  # gleiche API unter Windows
+    except ImportError:
+        fast_loop = None
+
 devices = {
     "akku-1": "A4:C1:38:A0:D1:5B",
     "akku-2": "A4:C1:38:A0:A0:59"
@@ -15,82 +27,321 @@ CHAR_NOTIFY = "0000ff01-0000-1000-8000-00805f9b34fb"
 CHAR_WRITE  = "0000ff02-0000-1000-8000-00805f9b34fb"
 CMD_CELLS   = bytes.fromhex("DD A5 04 00 FF FC 77")
 CMD_STATUS  = bytes.fromhex("DD A5 03 00 FF FD 77")
+CELLS_PREFIX  = b"\xDD\x04"  # Antwort-Kopf Zellspannungen
+STATUS_PREFIX = b"\xDD\x03"  # Antwort-Kopf Status
+FRAME_TIMEOUT = 1.5  # Sekunden, maximal auf eine Antwort warten
+POLL_INTERVAL = 5   # Sekunden pro Abfragezyklus
+# Rohdaten-Ausgabe pro Paket nur mit BATCHECK_DEBUG=1 (Log-Level DEBUG)
+DEBUG = os.environ.get("BATCHECK_DEBUG", "") not in ("", "0")  # jeder andere Wert schaltet ein
+log = logging.getLogger("batcheck")
 log_dir = "logs"
 os.makedirs(log_dir, exist_ok=True)
+last_stamp = [0, "--:--:--"]  # zuletzt formatierte Sekunde und Text
 csv_paths = {name: os.path.join(log_dir, f"{name}.csv") for name in devices}
+csv_files = {}
+csv_writers = {}
+csv_rows = {name: 0 for name in devices}
+CSV_FLUSH_ROWS = 10  # nach so vielen Zeilen auf die Karte schreiben
+CSV_BATCH_ROWS = 32  # höchstens so viele Zeilen pro writerows
+# (name, zeile), CSV_OPEN/CSV_CLOSE oder None zum Beenden, abgearbeitet von csv_writer_loop
+csv_queue = queue.SimpleQueue()
+CSV_OPEN = object()
+CSV_CLOSE = object()
 
 notify_buffer = {name: bytearray() for name in devices}
-device_data = {
-    name: dict(
-        connected=False,
-        status="Warte...",
-        last_update="--:--:--",
-        total=0.0,
-        strom=0.0,
-        soc=0,
-        voltages=[0.0]*16,
-    ) for name in devices
+notify_events = {}
+frame_events = {}  # je Pakettyp ein Event, gesetzt sobald so ein Paket geparst wurde
+clients = {}      # verbundene BleakClients, Abfragen laufen über command_worker
+lost_events = {}  # gesetzt, wenn die Verbindung eines Geräts weg ist
+NOTIFY_BATCH_DELAY = 0.05  # Sekunden, Fragmente sammeln bevor geparst wird
+NOTIFY_BUFFER_MAX = 4096   # darüber ist der Buffer nur noch Datenmüll
+NOTIFY_BUFFER_KEEP = 1024  # so viele Bytes bleiben beim Kürzen stehen
+FRAME_DATA_MAX = 64  # Byte Nutzdaten, reicht für 32 Zellen und jedes Statuspaket
+BAR_MIN_STEP = 0.0005  # V, kleinere Änderungen sieht man am Balken nicht
+VOLT_FMT = "{:.3f} V".format  # einmal gebunden, spart Lookup pro Zelle
+GUI_REFRESH_MS = 50  # ms, so oft werden geänderte Geräte neu gezeichnet
+TK_PUMP_INTERVAL = 0.02  # Sekunden zwischen zwei Tk-Update-Runden
+
+class Status:
+    # Verbindungszustand als Zahl, die GUI vergleicht nur noch ints
+    WAITING = 0
+    SCANNING = 1
+    CONNECTED = 2
+    DISCONNECTED = 3
+    ERROR = 4
+
+STATUS_TEXT = {
+    Status.WAITING: "Warte...",
+    Status.SCANNING: "Scanne...",
+    Status.DISCONNECTED: "Getrennt",
 }
+
+class DeviceState:
+    # Ein Objekt pro Gerät, Attribute statt dict-Schlüssel
+    __slots__ = ("status_code", "status_detail", "last_update", "total",
+                 "cell_sum", "strom", "soc", "voltages")
+
+    def __init__(self):
+        self.status_code = Status.WAITING
+        self.status_detail = ""  # Fehlertext, nur bei Status.ERROR gesetzt
+        self.last_update = "--:--:--"
+        self.total = 0.0
+        self.cell_sum = 0.0
+        self.strom = 0.0
+        self.soc = 0
+        self.voltages = [0.0]*16
+
+device_data = {name: DeviceState() for name in devices}
+dirty_devices = set(devices)  # Geräte mit neuen Daten, abgeholt von update_gui
 stop_event = threading.Event()
 log_active = threading.Event()
 
+def open_csv_logs():
+    # CSV-Dateien einmal öffnen statt pro Paket open/close
+    for name in devices:
+        csv_files[name] = open(csv_paths[name], "a", newline="", buffering=64*1024)
+        csv_writers[name] = csv.writer(csv_files[name])
+
+def close_csv_logs():
+    for f in csv_files.values():
+        f.close()
+    csv_files.clear()
+    csv_writers.clear()
+
+def write_csv_batch(batch):
+    # Pro Gerät ein writerows statt einer writerow pro Paket
+    rows = {}
+    for name, row in batch:
+        rows.setdefault(name, []).append(row)
+    batch.clear()
+    for name, dev_rows in rows.items():
+        writer = csv_writers.get(name)
+        if writer is None:
+            continue
+        writer.writerows(dev_rows)
+        csv_rows[name] += len(dev_rows)
+        if csv_rows[name] >= CSV_FLUSH_ROWS:
+            csv_files[name].flush()
+            csv_rows[name] = 0
+
+def csv_writer_loop():
+    # Eigener Thread besitzt die Dateien, langsame SD-Karten bremsen den Loop nicht
+    batch = []
+    while True:
+        item = csv_queue.get()
+        if item is None or item is CSV_OPEN or item is CSV_CLOSE:
+            write_csv_batch(batch)
+            close_csv_logs()
+            if item is None:
+                break
+            if item is CSV_OPEN:
+                open_csv_logs()
+            continue
+        batch.append(item)
+        if len(batch) >= CSV_BATCH_ROWS or csv_queue.empty():
+            write_csv_batch(batch)
+
+# Vorkompilierte Formate: Zellen je Anzahl (bis 32) und Status-Kopf
+CELL_STRUCTS = {n: struct.Struct(f">{n}H") for n in range(33)}
+STATUS_STRUCT = struct.Struct(">Hh")  # Spannung, Strom
+
+def timestamp():
+    # HH:MM:SS nur neu formatieren, wenn eine neue Sekunde angefangen hat
+    sec = int(time.time())
+    if sec != last_stamp[0]:
+        last_stamp[0] = sec
+        last_stamp[1] = time.strftime("%H:%M:%S", time.localtime(sec))
+    return last_stamp[1]
+
+def header_ok(buf, start):
+    # Plausibler Antwortkopf: Typ 03/04, Status 00/80, Länge im Rahmen.
+    # Sonst würde ein zufälliges DD mit großer Länge das Parsen aufhalten
+    return (buf[start+1] in PACKET_HANDLERS and buf[start+2] in (0x00, 0x80)
+            and buf[start+3] <= FRAME_DATA_MAX)
+
+def frame_ok(packet):
+    # Endbyte 77 und JBD-Prüfsumme: 0x10000 - Summe(Status, Länge, Daten), steht vor der 77
+    if len(packet) < 7 or packet[-1] != 0x77:
+        return False
+    s = sum(memoryview(packet)[2:-3])
+    return (0x10000 - s) & 0xFFFF == int.from_bytes(packet[-3:-1], "big")
+
 def parse_cell_voltages(packet):
     # BMS Zellpaket: DD 04 ... ... ... 77
-    if not packet.startswith(b'\xDD') or packet[1] != 0x04 or packet[-1] != 0x77:
+    if not (packet.startswith(CELLS_PREFIX) and packet.endswith(b"\x77")):
         return []
     # Im JBD-Protokoll steht im 4. Byte die Länge (z. B. 32 für 16 Zellen)
     # Header ist 4 Bytes (DD 04 LEN xx), dann die Daten, dann CRC (2B) und 77
     length = packet[3]
-    data = packet[4:4+length]
-    voltages = []
-    for i in range(0, len(data), 2):
-        if i + 1 >= len(data): break
-        v = int.from_bytes(data[i:i+2], 'big') / 1000.0
-        voltages.append(v)
-    return voltages
+    data = memoryview(packet)[4:4+length]
+    n = len(data) // 2
+    cell_struct = CELL_STRUCTS.get(n) or struct.Struct(f">{n}H")
+    raw = cell_struct.unpack_from(data)
+    return [v / 1000.0 for v in raw]
 
 def parse_status(packet):
     # BMS Statuspaket: DD 03 ... ... ... 77
-    if not packet.startswith(b'\xDD') or packet[1] != 0x03 or packet[-1] != 0x77:
+    if not (packet.startswith(STATUS_PREFIX) and packet.endswith(b"\x77")):
+        return {}
+    if len(packet) < 8:
         return {}
-    length = packet[3]
-    d = packet
     # Achtung: Indexierung je nach Protokoll
-    total_v = int.from_bytes(d[4:6], "big") / 100.0
-    strom_raw = int.from_bytes(d[6:8], "big", signed=True)
+    total_raw, strom_raw = STATUS_STRUCT.unpack_from(packet, 4)
+    total_v = total_raw / 100.0
     strom = strom_raw / 100.0
-    soc = d[23] if len(d) > 23 else 0
+    soc = packet[23] if len(packet) > 23 else 0
     return dict(total=total_v, strom=strom, soc=soc)
 
-async def monitor_bms(name, address):
+async def send_and_wait(name, client, cmd):
+    # Befehl schicken und auf das Antwortpaket warten (höchstens FRAME_TIMEOUT)
+    # Nur eine Antwort vom erwarteten Typ zählt (cmd[2]: 03 oder 04)
+    event = frame_events[name][cmd[2]]
+    event.clear()
+    await client.write_gatt_char(CHAR_WRITE, cmd)
+    try:
+        await asyncio.wait_for(event.wait(), timeout=FRAME_TIMEOUT)
+    except asyncio.TimeoutError:
+        pass
+
+def queue_poll(cmd_queue, name):
+    # Ein Abfragezyklus für ein Gerät: Zellen, dann Status
+    cmd_queue.put_nowait((name, CMD_CELLS))
+    cmd_queue.put_nowait((name, CMD_STATUS))
+
+async def poll_scheduler(cmd_queue):
+    # Ein Takt für alle Geräte statt einer eigenen Schleife pro Akku
+    while not stop_event.is_set():
+        started = time.monotonic()
+        # Hängt der Adapter noch am letzten Zyklus, diesen auslassen
+        if cmd_queue.empty():
+            for name in clients:
+                queue_poll(cmd_queue, name)
+        await wait_next_poll(started)
+
+async def command_worker(cmd_queue):
+    # Einziger Schreiber auf den Adapter: Befehle strikt nacheinander
+    while True:
+        name, cmd = await cmd_queue.get()
+        client = clients.get(name)
+        if client is None:
+            continue
+        try:
+            await send_and_wait(name, client, cmd)
+        except Exception as e:
+            d = device_data[name]
+            d.status_code = Status.ERROR
+            d.status_detail = f"Fehler: {str(e)[:25]}"
+            dirty_devices.add(name)
+            # Restliche Befehle für das Gerät laufen ins Leere bis zum Reconnect
+            clients.pop(name, None)
+            lost_events[name].set()
+
+async def wait_next_poll(started):
+    # Zyklus ab Start der Abfrage rechnen, Antwortzeit geht nicht obendrauf
+    await asyncio.sleep(max(0.0, POLL_INTERVAL - (time.monotonic() - started)))
+
+async def monitor_bms(name, address, cmd_queue):
+    # Ein Callback pro Gerät, über alle Reconnects hinweg
+    on_notify = functools.partial(handle_notify, name)
+    d = device_data[name]
     while not stop_event.is_set():
+        lost = asyncio.Event()
+        lost_events[name] = lost
         try:
-            device_data[name].update(connected=False, status="Scanne...")
-            async with BleakClient(address) as client:
-                device_data[name].update(connected=True, status="Verbunden")
-                notify_buffer[name] = bytearray()
-                await client.start_notify(CHAR_NOTIFY, lambda _, d: handle_notify(name, d))
-                while not stop_event.is_set():
-                    await client.write_gatt_char(CHAR_WRITE, CMD_CELLS)
-                    await asyncio.sleep(0.7)
-                    await client.write_gatt_char(CHAR_WRITE, CMD_STATUS)
-                    await asyncio.sleep(4.3)
+            d.status_code = Status.SCANNING
+            dirty_devices.add(name)
+            async with BleakClient(address, disconnected_callback=lambda _c, ev=lost: ev.set()) as client:
+                d.status_code = Status.CONNECTED
+                dirty_devices.add(name)
+                notify_buffer[name].clear()
+                notify_events[name] = asyncio.Event()
+                frame_events[name] = {typ: asyncio.Event() for typ in PACKET_HANDLERS}
+                drain_task = asyncio.create_task(drain_notify(name))
+                try:
+                    await client.start_notify(CHAR_NOTIFY, on_notify)
+                    # Abfragen schickt command_worker, hier nur Verbindung halten
+                    clients[name] = client
+                    # Erste Abfrage sofort, nicht erst beim nächsten Takt
+                    queue_poll(cmd_queue, name)
+                    await lost.wait()
+                finally:
+                    clients.pop(name, None)
+                    drain_task.cancel()
+            if d.status_code == Status.CONNECTED:
+                d.status_code = Status.DISCONNECTED
+                dirty_devices.add(name)
         except Exception as e:
-            device_data[name].update(connected=False, status=f"Fehler: {str(e)[:25]}")
+            d.status_code = Status.ERROR
+            d.status_detail = f"Fehler: {str(e)[:25]}"
+            dirty_devices.add(name)
         await asyncio.sleep(3)
 
-def handle_notify(name, data):
+def handle_notify(name, _sender, data):
+    # Nur puffern, geparst wird gesammelt in drain_notify
+    notify_buffer[name].extend(data)  # derselbe Buffer, kein Zurückschreiben ins dict
+    notify_events[name].set()
+
+async def drain_notify(name):
+    event = notify_events[name]
+    while True:
+        await event.wait()
+        # Kurz warten, damit die restlichen Fragmente des Pakets mitkommen
+        await asyncio.sleep(NOTIFY_BATCH_DELAY)
+        event.clear()
+        drain_and_parse(name)
+
+def handle_cells_packet(name, packet, now):
+    d = device_data[name]
+    voltages = parse_cell_voltages(packet)
+    if len(voltages) == 0:
+        print(f"[{name}] ⚠️ Ungültiges Zellenpaket!")
+    # Feste 16er-Liste überschreiben statt pro Paket neu aufzubauen
+    cells = d.voltages
+    n = min(len(voltages), 16)
+    cells[:n] = voltages[:n]
+    for i in range(n, 16):
+        cells[i] = 0.0
+    d.last_update = now
+    # Summe einmal pro Paket, die GUI liest nur noch den Wert
+    cell_sum = sum(voltages)
+    d.cell_sum = cell_sum
+    if voltages:
+        d.total = cell_sum
+    if log_active.is_set() and voltages:
+        csv_queue.put((name, [now]+voltages))
+
+def handle_status_packet(name, packet, now):
+    d = device_data[name]
+    s = parse_status(packet)
+    if s:
+        d.strom = s["strom"]
+        d.soc = s["soc"]
+        if not any(d.voltages):
+            d.total = s["total"]
+
+# Pakettyp (Byte 1) -> Auswertung
+PACKET_HANDLERS = {
+    0x04: handle_cells_packet,
+    0x03: handle_status_packet,
+}
+
+def drain_and_parse(name):
     buf = notify_buffer[name]
-    buf += data
+    # Ein Zeitstempel für alle Pakete dieses Durchlaufs
+    now = timestamp()
+    # Lesezeiger statt Löschen pro Paket, der Buffer wird einmal am Ende gekürzt
+    pos = 0
     while True:
         # Suche Start (0xDD) und prüfe, ob noch ein ganzes Paket vorhanden ist
-        if len(buf) < 7: break  # zu kurz
-        try:
-            start = buf.index(0xDD)
-        except ValueError:
-            buf = bytearray()  # kein Paket
+        if len(buf) - pos < 7: break  # zu kurz
+        start = buf.find(0xDD, pos)
+        if start < 0:
+            pos = len(buf)  # kein Paket, alles verwerfen
             break
         if len(buf) - start < 7: break  # Rest zu kurz
+        if not header_ok(buf, start):
+            pos = start + 1  # kein echter Paketanfang, weitersuchen
+            continue
         typ = buf[start+1]
         # Lese die Länge
         packet_len = buf[start+3]
@@ -100,36 +351,28 @@ def handle_notify(name, data):
         if len(buf) - start < total_len:
             # Warte auf den Rest
             break
-        packet = buf[start:start+total_len]
+        with memoryview(buf) as mv:
+            packet = bytes(mv[start:start+total_len])
         # Debug-Ausgabe
-        print(f"[{name}] [RAW] {packet.hex()}")
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("[%s] [RAW] %s", name, packet.hex())
         # Typ entscheiden:
-        if typ == 0x04:
-            # Zellenpaket
-            voltages = parse_cell_voltages(packet)
-            if len(voltages) == 0:
-                print(f"[{name}] ⚠️ Ungültiges Zellenpaket!")
-            device_data[name]["voltages"] = voltages + [0.0]*(16-len(voltages))
-            now = datetime.datetime.now().strftime("%H:%M:%S")
-            device_data[name]["last_update"] = now
-            if voltages:
-                device_data[name]["total"] = sum(voltages)
-            if log_active.is_set() and voltages:
-                with open(csv_paths[name], "a", newline="") as f:
-                    csv.writer(f).writerow([now]+voltages)
-        elif typ == 0x03:
-            # Statuspaket
-            s = parse_status(packet)
-            if s:
-                device_data[name]["strom"] = s["strom"]
-                device_data[name]["soc"] = s["soc"]
-                if not any(device_data[name]["voltages"]):
-                    device_data[name]["total"] = s["total"]
-        else:
-            print(f"[{name}] ⚠️ Unbekannter Pakettyp {typ:02X}")
-        # Nächstes Paket aus Buffer holen
-        buf = buf[start+total_len:]
-    notify_buffer[name] = buf
+        if not frame_ok(packet):
+            print(f"[{name}] ⚠️ Prüfsumme oder Endbyte falsch, Paket verworfen")
+            # Längenbyte war falsch, ab dem nächsten Byte neu suchen
+            pos = start + 1
+            continue
+        pos = start + total_len
+        event = frame_events[name].get(typ)
+        if event:
+            event.set()
+        dirty_devices.add(name)
+        PACKET_HANDLERS[typ](name, packet, now)
+    # Verbrauchte Bytes im selben Buffer entfernen statt Rest zu kopieren
+    del buf[:pos]
+    # Unvollständiger Rest wächst ohne Endbyte nicht unbegrenzt
+    if len(buf) > NOTIFY_BUFFER_MAX:
+        del buf[:len(buf)-NOTIFY_BUFFER_KEEP]
 
 class BMSGUI(tk.Tk):
     def __init__(self):
@@ -137,9 +380,11 @@ class BMSGUI(tk.Tk):
         self.title("SmartBMS Dual Monitor")
         self.configure(bg="#222834")
         self.bms_frames = {}
+        # Zuletzt angezeigte Werte, damit update_gui nur Änderungen an Tk gibt
+        self._last = {name: {} for name in devices}
         self._build_gui()
         self.protocol("WM_DELETE_WINDOW", self.stop)
-        self.after(500, self.update_gui)
+        self.after(GUI_REFRESH_MS, self.update_gui)
 
     def _build_gui(self):
         self.header = tk.Label(self, text="SmartBMS Monitor", font=("Segoe UI", 22, "bold"),
@@ -158,13 +403,16 @@ class BMSGUI(tk.Tk):
             addr_lbl.pack(pady=(0,1))
             self.bms_frames[name] = {}
             self.bms_frames[name]["addr_lbl"] = addr_lbl
-            self.bms_frames[name]["vlabel"] = tk.Label(frame, text="Gesamt: -- V", font=("Segoe UI", 16, "bold"),
+            self.bms_frames[name]["vlabel_var"] = tk.StringVar(self, value="Gesamt: -- V")
+            self.bms_frames[name]["vlabel"] = tk.Label(frame, textvariable=self.bms_frames[name]["vlabel_var"], font=("Segoe UI", 16, "bold"),
                                                        bg="#232b36", fg="#16e2ba")
             self.bms_frames[name]["vlabel"].pack(pady=(5, 0))
-            self.bms_frames[name]["ilabel"] = tk.Label(frame, text="Strom: -- A", font=("Segoe UI", 15, "bold"),
+            self.bms_frames[name]["ilabel_var"] = tk.StringVar(self, value="Strom: -- A")
+            self.bms_frames[name]["ilabel"] = tk.Label(frame, textvariable=self.bms_frames[name]["ilabel_var"], font=("Segoe UI", 15, "bold"),
                                                        bg="#232b36", fg="#fe912a")
             self.bms_frames[name]["ilabel"].pack(pady=(0, 0))
-            self.bms_frames[name]["soc"] = tk.Label(frame, text="SoC: -- %", font=("Segoe UI", 14, "bold"),
+            self.bms_frames[name]["soc_var"] = tk.StringVar(self, value="SoC: -- %")
+            self.bms_frames[name]["soc"] = tk.Label(frame, textvariable=self.bms_frames[name]["soc_var"], font=("Segoe UI", 14, "bold"),
                                                     bg="#232b36", fg="#ffb140")
             self.bms_frames[name]["soc"].pack(pady=2)
             cell_frame = tk.Frame(frame, bg="#232b36")
@@ -176,13 +424,17 @@ class BMSGUI(tk.Tk):
                 f.pack(fill="x", padx=2, pady=1)
                 num = tk.Label(f, text=f"{i+1:02d}", width=3, font=("Consolas", 11, "bold"), bg=bar_bg, fg="#888")
                 num.pack(side="left", padx=(0,3))
-                b = ttk.Progressbar(f, length=145, mode="determinate")
+                b = ttk.Progressbar(f, length=145, mode="determinate", maximum=4.3 * 100)
                 b.pack(side="left", padx=(1, 6), pady=0)
-                l = tk.Label(f, text="--.- V", width=7, anchor="w", font=("Consolas", 12, "bold"),
+                var = tk.StringVar(self, value="--.- V")
+                l = tk.Label(f, textvariable=var, width=7, anchor="w", font=("Consolas", 12, "bold"),
                              bg=bar_bg, fg="#18fbd4")
                 l.pack(side="left")
-                self.bms_frames[name]["bars"].append((b, l, num))
-            self.bms_frames[name]["conn"] = tk.Label(frame, text="⏳ Warte...", font=("Consolas", 11),
+                # Zuletzt gezeigter Wert pro Zelle, update nur bei Änderung
+                cache = {"text": None, "fg": "#18fbd4", "val": -1.0}
+                self.bms_frames[name]["bars"].append((b, l, num, var, cache))
+            self.bms_frames[name]["conn_var"] = tk.StringVar(self, value="⏳ Warte...")
+            self.bms_frames[name]["conn"] = tk.Label(frame, textvariable=self.bms_frames[name]["conn_var"], font=("Consolas", 11),
                                                      bg="#232b36", fg="#BBB", anchor="w", width=32)
             self.bms_frames[name]["conn"].pack(pady=(6, 4))
 
@@ -197,48 +449,69 @@ class BMSGUI(tk.Tk):
         self._logging = False
 
     def update_gui(self):
-        for name in devices:
-            frame = self.bms_frames[name]
-            d = device_data[name]
-            if d["connected"]:
-                t = f"✓ Verbunden ({d['last_update']})"
-            elif "Fehler" in d["status"]:
-                t = d["status"][:30] + ("…" if len(d["status"]) > 30 else "")
-            else:
-                t = d["status"]
-            frame["conn"].config(text=t)
-            volt_sum = sum(d["voltages"])
-            if volt_sum > 2:
-                frame["vlabel"].config(text=f"Gesamt: {volt_sum:.3f} V")
-            elif d["total"] > 0:
-                frame["vlabel"].config(text=f"Gesamt: {d['total']:.3f} V")
-            else:
-                frame["vlabel"].config(text="Gesamt: -- V")
-            frame["ilabel"].config(text=f"Strom: {d['strom']:.2f} A")
-            frame["soc"].config(text=f"SoC: {d['soc']} %")
-            for i, (bar, lab, num) in enumerate(frame["bars"]):
-                try:
-                    v = d["voltages"][i]
-                    bar["value"] = v * 100
-                    bar["maximum"] = 4.3 * 100
-                    lab["text"] = f"{v:.3f} V"
-                    lab["fg"] = "#18fbd4" if 3.1 < v < 4.25 else "#fd4b4b"
-                except IndexError:
-                    bar["value"] = 0
-                    lab["text"] = "--.- V"
-                    lab["fg"] = "#999"
-        self.log_btn.config(bg="#0b75da" if self._logging else "#184b87")
-        self.after(500, self.update_gui)
+        # Nur Geräte neu zeichnen, für die seit dem letzten Mal Daten kamen
+        while dirty_devices:
+            self._refresh_device(dirty_devices.pop())
+        self.after(GUI_REFRESH_MS, self.update_gui)
+
+    def _refresh_device(self, name):
+        frame = self.bms_frames[name]
+        d = device_data[name]
+        code = d.status_code
+        if code == Status.CONNECTED:
+            t = f"✓ Verbunden ({d.last_update})"
+        elif code == Status.ERROR:
+            t = d.status_detail[:30] + ("…" if len(d.status_detail) > 30 else "")
+        else:
+            t = STATUS_TEXT[code]
+        self._set_text(name, "conn", t)
+        volt_sum = d.cell_sum
+        if volt_sum > 2:
+            t = f"Gesamt: {volt_sum:.3f} V"
+        elif d.total > 0:
+            t = f"Gesamt: {d.total:.3f} V"
+        else:
+            t = "Gesamt: -- V"
+        self._set_text(name, "vlabel", t)
+        self._set_text(name, "ilabel", f"Strom: {d.strom:.2f} A")
+        self._set_text(name, "soc", f"SoC: {d.soc} %")
+        voltages = d.voltages
+        for i, (bar, lab, num, var, cache) in enumerate(frame["bars"]):
+            v = voltages[i]
+            # Balken nur bewegen, wenn sich der Wert sichtbar ändert
+            if abs(v - cache["val"]) >= BAR_MIN_STEP:
+                bar["value"] = v * 100
+                cache["val"] = v
+            t = VOLT_FMT(v)
+            if cache["text"] != t:
+                var.set(t)
+                cache["text"] = t
+            fg = "#18fbd4" if 3.1 < v < 4.25 else "#fd4b4b"
+            if cache["fg"] != fg:
+                lab["fg"] = fg
+                cache["fg"] = fg
+
+    def _set_text(self, name, key, text):
+        # Tk-Widget nur anfassen, wenn sich der Text geändert hat
+        last = self._last[name]
+        if last.get(key) != text:
+            self.bms_frames[name][key + "_var"].set(text)
+            last[key] = text
 
     def toggle_logging(self):
         self._logging = not self._logging
+        # CSV-Dateien nur offen halten, solange geloggt wird
         if self._logging:
+            csv_queue.put(CSV_OPEN)
             log_active.set()
         else:
             log_active.clear()
+            csv_queue.put(CSV_CLOSE)
+        self.log_btn.config(bg="#0b75da" if self._logging else "#184b87")
 
     def stop(self):
         stop_event.set()
+        log_active.clear()
         self.destroy()
         print("⛔️ Beende Programm...")
 
@@ -248,23 +521,48 @@ def setup_styles(root):
     style.configure("TProgressbar", thickness=13, troughcolor="#232b36",
                     background="#18fbd4", bordercolor="#232934", lightcolor="#45e3ba", darkcolor="#19e2ba")
 
-def run_asyncio_thread():
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
+async def tk_pump(gui):
+    # Tk-Events im asyncio-Loop abarbeiten, BLE und GUI laufen im selben Thread
+    while not stop_event.is_set():
+        try:
+            gui.update()
+        except tk.TclError:
+            break  # Fenster bereits zerstört
+        await asyncio.sleep(TK_PUMP_INTERVAL)
+
+async def run_all(gui):
     tasks = []
+    cmd_queue = asyncio.Queue()
     for name, addr in devices.items():
-        tasks.append(loop.create_task(monitor_bms(name, addr)))
+        tasks.append(asyncio.create_task(monitor_bms(name, addr, cmd_queue)))
+    tasks.append(asyncio.create_task(poll_scheduler(cmd_queue)))
+    tasks.append(asyncio.create_task(command_worker(cmd_queue)))
+    try:
+        await tk_pump(gui)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+def run_event_loop(gui):
+    loop = fast_loop.new_event_loop() if fast_loop else asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
     try:
-        loop.run_until_complete(asyncio.gather(*tasks))
+        loop.run_until_complete(run_all(gui))
     except Exception as e:
-        print("Asyncio-Thread: ", e)
+        print("Asyncio: ", e)
     finally:
         loop.close()
 
 if __name__ == "__main__":
+    logging.basicConfig(format="%(message)s", level=logging.INFO)
+    # Nur die eigenen Rohdaten auf DEBUG, bleak und dbus bleiben auf INFO
+    log.setLevel(logging.DEBUG if DEBUG else logging.INFO)
+    csv_thread = threading.Thread(target=csv_writer_loop, daemon=True)
+    csv_thread.start()
     gui = BMSGUI()
     setup_styles(gui)
-    t = threading.Thread(target=run_asyncio_thread, daemon=True)
-    t.start()
-    gui.mainloop()
+    run_event_loop(gui)
     stop_event.set()
+    csv_queue.put(None)  # Rest schreiben und Dateien schließen
+    csv_thread.join()